@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import socket
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from torchvision.datasets import ImageFolder
+from torchvision.transforms import Compose, Resize, CenterCrop
+
+def __to_array__(img):
+    return np.asarray(img, dtype=np.uint8)
+
+def __read_meta__(split_dir):
+    meta_path = os.path.join(split_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+def __get_source__(image_dir):
+    # identifies the images a split was built from; a cache built from other images is stale
+    dataset = ImageFolder(image_dir)
+    return {
+        'data_dir': os.path.realpath(image_dir),
+        'num_samples': len(dataset),
+        'classes': dataset.classes
+    }
+
+def __is_cached__(split_dir, source, input_size):
+    # meta.json is written last, so its presence means the split is complete
+    meta = __read_meta__(split_dir)
+    if meta is None:
+        return False
+    return meta['input_size'] == input_size and all(meta[k] == v for k, v in source.items())
+
+def __build_split__(image_dir, split_dir, source, input_size, num_workers):
+    dataset = ImageFolder(image_dir, transform=Compose([Resize(input_size), CenterCrop(input_size), __to_array__]))
+    n = len(dataset)
+
+    os.makedirs(split_dir, exist_ok=True)
+    # a stale meta.json is left in place: it does not match the new source, so the split is not
+    # considered cached until the new one is written, and another builder may already have written it
+    meta_path = os.path.join(split_dir, 'meta.json')
+
+    # per process temporaries; builders on other nodes may share the directory, and each file is swapped in atomically
+    tmp_path = os.path.join(split_dir, 'images.{}.{}.tmp.npy'.format(socket.gethostname(), os.getpid()))
+    tmp_labels_path = os.path.join(split_dir, 'labels.{}.{}.tmp.npy'.format(socket.gethostname(), os.getpid()))
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(n, input_size, input_size, 3))
+    labels = np.empty(n, dtype=np.int64)
+
+    # batch_size=None yields single samples in order, decoded by the workers
+    loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+    for i, (img, label) in enumerate(loader):
+        images[i] = img.numpy()
+        labels[i] = label
+
+    images.flush()
+    del images
+    os.replace(tmp_path, os.path.join(split_dir, 'images.npy'))
+    np.save(tmp_labels_path, labels)
+    os.replace(tmp_labels_path, os.path.join(split_dir, 'labels.npy'))
+
+    meta = dict(source, input_size=input_size)
+    with open(meta_path, 'w') as f:
+        f.write(json.dumps(meta, indent=1))
+
+def build_cache(data_dir, cache_dir, input_size, samples, num_workers=0):
+    """
+    Decodes, resizes and center crops the images of each split once, and
+    stores them as a memory-mapped uint8 array (N x H x W x 3) with their
+    labels. Splits already cached from the same data directory (resolved
+    path, classes and number of images) are skipped; otherwise they are
+    rebuilt.
+    """
+    for x in samples:
+        image_dir = os.path.join(data_dir, x)
+        split_dir = os.path.join(cache_dir, x)
+        source = __get_source__(image_dir)
+        if __is_cached__(split_dir, source, input_size):
+            print('using cached {} images in {}'.format(x, split_dir))
+            continue
+        print('caching {} images to {}'.format(x, split_dir))
+        __build_split__(image_dir, split_dir, source, input_size, num_workers)
+
+def wait_for_cache(data_dir, cache_dir, input_size, samples, timeout, poll_interval=5):
+    """
+    Waits until another process has built the cache of each split from
+    the data directory, by polling the cache files. Raises a TimeoutError
+    if the cache is not complete after timeout seconds.
+    """
+    sources = {x: __get_source__(os.path.join(data_dir, x)) for x in samples}
+    deadline = time.time() + timeout
+    while not all(__is_cached__(os.path.join(cache_dir, x), sources[x], input_size) for x in samples):
+        if time.time() > deadline:
+            raise TimeoutError('image cache in {} was not built within {} seconds; '
+                'the process with LOCAL_RANK 0 on this node builds it, check that it is running '
+                'and increase --cache_timeout for large datasets'.format(cache_dir, timeout))
+        time.sleep(poll_interval)
+
+class MmapImageDataset(Dataset):
+    """
+    Dataset over a split written by build_cache. Images are read from the
+    memory-mapped array, so no JPEG decoding happens per epoch; each sample
+    is handed to the transform as a PIL image, like ImageFolder does.
+    """
+
+    def __init__(self, root, transform=None):
+        self.root = root
+        self.transform = transform
+        self.targets = np.load(os.path.join(root, 'labels.npy'))
+        self.classes = __read_meta__(root)['classes']
+        # opened lazily so that each worker process maps the file itself
+        self.images = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.load(os.path.join(self.root, 'images.npy'), mmap_mode='r')
+
+        img = Image.fromarray(np.asarray(self.images[index]))
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.targets[index])
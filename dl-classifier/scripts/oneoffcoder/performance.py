@@ -2,9 +2,9 @@ import torch
 import torch.nn.functional as F
 from sklearn.preprocessing import label_binarize
 from sklearn.metrics import roc_curve, auc, precision_recall_curve, average_precision_score
-from scipy import interp
 import numpy as np
 from collections import namedtuple
+from .transform import get_normalize_params, normalize_batch
 import matplotlib.pyplot as plt
 import seaborn as sns
 import time
@@ -12,10 +12,12 @@ import json
 
 PREDICTION = namedtuple('Prediction', 'P y')
 
-def __get_predictions__(model, dataloaders, dataset_key='valid'):
+def __get_predictions__(model, dataloaders, dataset_key='valid', normalize=None):
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     P = []
 
+    normalize_params = get_normalize_params(normalize, device)
+
     was_training = model.training
     model.eval()
 
@@ -23,6 +25,7 @@ def __get_predictions__(model, dataloaders, dataset_key='valid'):
         for _, (inputs, labels) in enumerate(dataloaders[dataset_key]):
             inputs = inputs.to(device)
             labels = labels.to(device)
+            inputs = normalize_batch(inputs, normalize_params)
 
             labels = labels.cpu().detach().numpy()
             outputs = model(inputs)
@@ -61,7 +64,7 @@ def __get_roc_stats__(V):
     all_fpr = np.unique(np.concatenate([fpr[i] for i in range(n_classes)]))
     mean_tpr = np.zeros_like(all_fpr)
     for i in range(n_classes):
-        mean_tpr += interp(all_fpr, fpr[i], tpr[i])
+        mean_tpr += np.interp(all_fpr, fpr[i], tpr[i])
     mean_tpr /= n_classes
     fpr['macro'] = all_fpr
     tpr['macro'] = mean_tpr
@@ -148,11 +151,11 @@ def __plot__(phase, S, ms, output_dir, figure_width, figure_height, figure_type=
     plt.tight_layout()
 
     file_path = '{}/oneoffcoder-{}-{}.{}'.format(output_dir, ms, phase, figure_type)
-    fig.savefig(file_path, quality=100, optimize=True)
+    fig.savefig(file_path, pil_kwargs={'quality': 100, 'optimize': True})
     plt.close()
     print('saved {}'.format(file_path))
 
-def get_predictions(model, dataloaders):
+def get_predictions(model, dataloaders, normalizations=None):
     def get_stats(V):
         tpr, fpr, roc_auc, roc_keys = __get_roc_stats__(R)
         pre, rec, avg_pre, base, pr_keys = __get_pr_stats__(R)
@@ -173,9 +176,10 @@ def get_predictions(model, dataloaders):
         }
         return stats
     
-    R = __get_predictions__(model, dataloaders, dataset_key='train')
-    E = __get_predictions__(model, dataloaders, dataset_key='test')
-    V = __get_predictions__(model, dataloaders, dataset_key='valid')
+    normalizations = {} if normalizations is None else normalizations
+    R = __get_predictions__(model, dataloaders, dataset_key='train', normalize=normalizations.get('train'))
+    E = __get_predictions__(model, dataloaders, dataset_key='test', normalize=normalizations.get('test'))
+    V = __get_predictions__(model, dataloaders, dataset_key='valid', normalize=normalizations.get('valid'))
 
     R_S = get_stats(R)
     E_S = get_stats(E)
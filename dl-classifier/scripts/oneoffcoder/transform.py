@@ -1,3 +1,4 @@
+import torch
 from torchvision.transforms import *
 from collections import namedtuple
 import json
@@ -164,4 +165,30 @@ def get_transforms(transform_options):
     __clean_transient_transforms__(transforms)
 
     transforms = __get_final_transforms__(transforms)
-    return transforms
\ No newline at end of file
+    return transforms
+
+def split_normalize(transforms):
+    # a trailing Normalize is removed from each phase so it can be applied to whole batches on the device
+    normalizations = {}
+    for phase, t in transforms.items():
+        if isinstance(t, Compose) and len(t.transforms) > 0 and isinstance(t.transforms[-1], Normalize):
+            normalizations[phase] = t.transforms[-1]
+            transforms[phase] = Compose(t.transforms[:-1])
+        else:
+            normalizations[phase] = None
+    return transforms, normalizations
+
+def get_normalize_params(normalize, device):
+    # mean and std of a split out Normalize, on the device and shaped to broadcast over a batch
+    if normalize is None:
+        return None
+    mean = torch.tensor(normalize.mean, device=device).view(1, -1, 1, 1)
+    std = torch.tensor(normalize.std, device=device).view(1, -1, 1, 1)
+    return mean, std
+
+def normalize_batch(inputs, params):
+    # normalizes a batch in place with params from get_normalize_params
+    if params is None:
+        return inputs
+    mean, std = params
+    return inputs.sub_(mean).div_(std)
@@ -6,6 +6,9 @@ import json
 import random
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
 import torch.optim as optim
 from torch.optim import lr_scheduler
 import numpy as np
@@ -13,20 +16,88 @@ import torchvision
 from torchvision import datasets, models, transforms
 import matplotlib.pyplot as plt
 import time
-import copy
 from collections import namedtuple
+from contextlib import nullcontext
 from sklearn.metrics import multilabel_confusion_matrix
 from collections import namedtuple
 from argparse import RawTextHelpFormatter
-from oneoffcoder.transform import get_default_transforms, get_transforms
+from oneoffcoder.transform import get_default_transforms, get_transforms, split_normalize, get_normalize_params, normalize_batch
 from oneoffcoder.performance import get_predictions, save_predictions
+from oneoffcoder.cache import build_cache, wait_for_cache, MmapImageDataset
+
+def is_distributed():
+    """
+    Determines if we are running distributed, i.e. launched with torchrun
+    and more than one process.
+    :return: A boolean indicating if training is distributed.
+    """
+    return int(os.environ.get('WORLD_SIZE', 1)) > 1
+
+
+def get_local_rank():
+    """
+    Gets the rank of this process on the local node.
+    :return: Local rank (0 if not distributed).
+    """
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    """
+    Determines if this is the main (rank 0) process. Only the main process
+    saves models and predictions.
+    :return: A boolean indicating if this is the main process.
+    """
+    return int(os.environ.get('RANK', 0)) == 0
+
+
+def is_local_main_process():
+    """
+    Determines if this is the main (local rank 0) process of its node.
+    Node-local work, such as building the image cache, is done by it.
+    :return: A boolean indicating if this is the main process of the node.
+    """
+    return get_local_rank() == 0
+
+
+def init_distributed():
+    """
+    Initializes the NCCL process group if we are running distributed.
+    :return: None.
+    """
+    if is_distributed() and not dist.is_initialized():
+        torch.cuda.set_device(get_local_rank())
+        dist.init_process_group('nccl')
+
+
+def cleanup_distributed():
+    """
+    Destroys the process group if one was initialized.
+    :return: None.
+    """
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
 
 def get_device():
     """
     Gets the device.
-    :return: cuda:0 or cpu.
+    :return: cuda:[local_rank] or cpu.
     """
-    return torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    return torch.device('cuda:{}'.format(get_local_rank()) if torch.cuda.is_available() else 'cpu')
+
+
+def configure_backends():
+    """
+    Configures the CUDA backends. TF32 is allowed for matmul and cuDNN
+    convolutions, and the cuDNN autotuner is enabled since the input size
+    and batch size are fixed for a run.
+    :return: None.
+    """
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
 
 
 def get_input_size(model_type):
@@ -49,6 +120,30 @@ def determine_inception(model_type):
     return True if model_type == 'inception_v3' else False
 
 
+def get_autocast_dtype(device):
+    """
+    Gets the reduced precision type used for automatic mixed precision.
+    BF16 is used when the GPU supports it, else FP16 (which requires
+    gradient scaling).
+    :param device: Device.
+    :return: torch.bfloat16 or torch.float16.
+    """
+    if device.type == 'cuda' and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
+def get_memory_format(is_inception):
+    """
+    Gets the memory format for the model and its inputs. Convolutional
+    backbones use channels last (NHWC) so that cuDNN can dispatch to tensor
+    core kernels without transposing; Inception v3 is kept contiguous (NCHW).
+    :param is_inception: A boolean indicating if the model is Inception v3.
+    :return: torch.contiguous_format or torch.channels_last.
+    """
+    return torch.contiguous_format if is_inception else torch.channels_last
+
+
 def set_parameter_requires_grad(model, feature_extracting):
     """
     Sets the parameters of the model to False
@@ -62,6 +157,84 @@ def set_parameter_requires_grad(model, feature_extracting):
             param.requires_grad = False
 
 
+def freeze_bn(model):
+    """
+    Puts the BatchNorm layers of the model in evaluation mode so that their
+    running statistics are not updated. Used when feature extracting, where
+    the pretrained statistics should be kept.
+    :param model: Model.
+    :return: None.
+    """
+    for m in model.modules():
+        if isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)):
+            m.eval()
+
+
+def __replace_fc__(model, num_classes):
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+
+
+def __replace_classifier__(model, num_classes):
+    model.classifier = nn.Linear(model.classifier.in_features, num_classes)
+
+
+def __replace_classifier1__(model, num_classes):
+    model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
+
+
+def __replace_classifier6__(model, num_classes):
+    model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
+
+
+def __replace_alexnet_classifier__(model, num_classes):
+    model.classifier[6] = nn.Linear(4096, num_classes)
+
+
+def __replace_squeezenet_classifier__(model, num_classes):
+    model.classifier[1] = nn.Conv2d(512, num_classes, kernel_size=(1,1), stride=(1,1))
+    model.num_classes = num_classes
+
+
+def __replace_inception_heads__(model, num_classes):
+    model.AuxLogits.fc = nn.Linear(model.AuxLogits.fc.in_features, num_classes)
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+
+
+# model type -> (constructor, head replacer); anything not listed is treated as Inception v3
+MODEL_REGISTRY = {
+    'resnet18': (models.resnet18, __replace_fc__),
+    'resnet34': (models.resnet34, __replace_fc__),
+    'resnet50': (models.resnet50, __replace_fc__),
+    'resnet101': (models.resnet101, __replace_fc__),
+    'resnet152': (models.resnet152, __replace_fc__),
+    'alexnet': (models.alexnet, __replace_alexnet_classifier__),
+    'vgg11': (models.vgg11, __replace_classifier6__),
+    'vgg11_bn': (models.vgg11_bn, __replace_classifier6__),
+    'vgg13': (models.vgg13, __replace_classifier6__),
+    'vgg13_bn': (models.vgg13_bn, __replace_classifier6__),
+    'vgg16': (models.vgg16, __replace_classifier6__),
+    'vgg16_bn': (models.vgg16_bn, __replace_classifier6__),
+    'vgg19': (models.vgg19, __replace_classifier6__),
+    'vgg19_bn': (models.vgg19_bn, __replace_classifier6__),
+    'squeezenet1_0': (models.squeezenet1_0, __replace_squeezenet_classifier__),
+    'squeezenet1_1': (models.squeezenet1_1, __replace_squeezenet_classifier__),
+    'densenet121': (models.densenet121, __replace_classifier__),
+    'densenet161': (models.densenet161, __replace_classifier__),
+    'densenet169': (models.densenet169, __replace_classifier__),
+    'densenet201': (models.densenet201, __replace_classifier__),
+    'googlenet': (models.googlenet, __replace_fc__),
+    'shufflenet_v2_x0_5': (models.shufflenet_v2_x0_5, __replace_fc__),
+    'shufflenet_v2_x1_0': (models.shufflenet_v2_x1_0, __replace_fc__),
+    'mobilenet_v2': (models.mobilenet_v2, __replace_classifier1__),
+    'resnext50_32x4d': (models.resnext50_32x4d, __replace_fc__),
+    'resnext101_32x8d': (models.resnext101_32x8d, __replace_fc__),
+    'wide_resnet50_2': (models.wide_resnet50_2, __replace_fc__),
+    'wide_resnet101_2': (models.wide_resnet101_2, __replace_fc__),
+    'mnasnet0_5': (models.mnasnet0_5, __replace_classifier1__),
+    'mnasnet1_0': (models.mnasnet1_0, __replace_classifier1__)
+}
+
+
 def create_model(model_type, num_classes, feature_extract, pretrained):
     """
     Creates a model.
@@ -72,134 +245,32 @@ def create_model(model_type, num_classes, feature_extract, pretrained):
     :return: Model.
     """
     device = get_device()
-    if 'resnet18' == model_type:
-        model = models.resnet18(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'resnet34' == model_type:
-        model = models.resnet34(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'resnet50' == model_type:
-        model = models.resnet50(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'resnet101' == model_type:
-        model = models.resnet101(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'resnet152' == model_type:
-        model = models.resnet152(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'alexnet' == model_type:
-        model = models.alexnet(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(4096, num_classes)
-    elif 'vgg11' == model_type:
-        model = models.vgg11(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
-    elif 'vgg11_bn' == model_type:
-        model = models.vgg11_bn(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
-    elif 'vgg13' == model_type:
-        model = models.vgg13(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
-    elif 'vgg13_bn' == model_type:
-        model = models.vgg13_bn(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
-    elif 'vgg16' == model_type:
-        model = models.vgg16(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
-    elif 'vgg16_bn' == model_type:
-        model = models.vgg16_bn(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
-    elif 'vgg19' == model_type:
-        model = models.vgg19(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
-    elif 'vgg19_bn' == model_type:
-        model = models.vgg19_bn(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[6] = nn.Linear(model.classifier[6].in_features, num_classes)
-    elif 'squeezenet1_0' == model_type:
-        model = models.squeezenet1_0(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[1] = nn.Conv2d(512, num_classes, kernel_size=(1,1), stride=(1,1))
-        model.num_classes = num_classes
-    elif 'squeezenet1_1' == model_type:
-        model = models.squeezenet1_1(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[1] = nn.Conv2d(512, num_classes, kernel_size=(1,1), stride=(1,1))
-        model.num_classes = num_classes
-    elif 'densenet121' == model_type:
-        model = models.densenet121(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier = nn.Linear(model.classifier.in_features, num_classes)
-    elif 'densenet161' == model_type:
-        model = models.densenet161(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier = nn.Linear(model.classifier.in_features, num_classes)
-    elif 'densenet169' == model_type:
-        model = models.densenet169(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier = nn.Linear(model.classifier.in_features, num_classes)
-    elif 'densenet201' == model_type:
-        model = models.densenet201(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier = nn.Linear(model.classifier.in_features, num_classes)
-    elif 'googlenet' == model_type:
-        model = models.googlenet(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'shufflenet_v2_x0_5' == model_type:
-        model = models.shufflenet_v2_x0_5(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'shufflenet_v2_x1_0' == model_type:
-        model = models.shufflenet_v2_x1_0(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'mobilenet_v2' == model_type:
-        model = models.mobilenet_v2(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
-    elif 'resnext50_32x4d' == model_type:
-        model = models.resnext50_32x4d(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
-    elif 'resnext101_32x8d' == model_type:
-        model = models.resnext101_32x8d(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'wide_resnet50_2' == model_type:
-        model = models.wide_resnet50_2(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'wide_resnet101_2' == model_type:
-        model = models.wide_resnet101_2(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    elif 'mnasnet0_5' == model_type:
-        model = models.mnasnet0_5(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
-    elif 'mnasnet1_0' == model_type:
-        model = models.mnasnet1_0(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
-    else:
-        model = models.inception_v3(pretrained=pretrained)
-        set_parameter_requires_grad(model, feature_extract)
-        model.AuxLogits.fc = nn.Linear(model.AuxLogits.fc.in_features, num_classes)
-        model.fc = nn.Linear(model.fc.in_features, num_classes)
-    return model.to(device)
+    constructor, replace_head = MODEL_REGISTRY.get(model_type, (models.inception_v3, __replace_inception_heads__))
+    model = constructor(pretrained=pretrained)
+    set_parameter_requires_grad(model, feature_extract)
+    replace_head(model, num_classes)
+    model = model.to(device, memory_format=get_memory_format(determine_inception(model_type)))
+
+    if is_distributed():
+        model = DDP(model, device_ids=[get_local_rank()])
+
+    if hasattr(torch, 'compile') and torch.cuda.is_available():
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+
+    return model
+
+
+def unwrap_model(model):
+    """
+    Gets the underlying model if it has been compiled with torch.compile
+    and/or wrapped with DistributedDataParallel. State dictionaries are saved
+    and loaded against the underlying model so that their keys do not depend
+    on compilation or distribution.
+    :param model: Model.
+    :return: Model.
+    """
+    model = getattr(model, '_orig_mod', model)
+    return model.module if isinstance(model, DDP) else model
 
 
 def get_criterion():
@@ -212,12 +283,22 @@ def get_criterion():
 
 def get_optimizer(params_to_update, params):
     """
-    Gets the optimizer. Only SGD is supported.
+    Gets the optimizer. Only SGD is supported. The fused (CUDA) implementation
+    is used when available, falling back to the multi-tensor (foreach) one,
+    unless either is explicitly set in the parameters.
     :param params_to_update: Model parameters to update.
     :param params: Parameters to the optimizer.
     :return: Optimizer.
     """
-    return optim.SGD(params_to_update, **params)
+    if 'fused' in params or 'foreach' in params:
+        return optim.SGD(params_to_update, **params)
+
+    params_to_update = list(params_to_update)
+    try:
+        return optim.SGD(params_to_update, fused=torch.cuda.is_available(), **params)
+    except TypeError:
+        # older PyTorch without fused SGD
+        return optim.SGD(params_to_update, foreach=True, **params)
 
 
 def get_scheduler(optimizer, params):
@@ -230,13 +311,30 @@ def get_scheduler(optimizer, params):
     return lr_scheduler.StepLR(optimizer, **params)
 
 
-def get_dataloaders(data_dir, data_transforms, batch_size, num_workers):
+def seed_worker(worker_id):
+    """
+    Seeds Python and NumPy in a data loader worker from the worker's torch
+    seed, which is derived from the seed of the main process, so that
+    workers are reproducible across runs.
+    :param worker_id: Worker id.
+    :return: None.
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def get_dataloaders(data_dir, data_transforms, batch_size, num_workers, samples=['train', 'test', 'valid'], cache_dir=None, training=True):
     """
     Gets the data loaders.
     :param data_dir: Root path to data with images.
     :param data_transforms: The data transforms.
     :param batch_size: The batch size used during training.
     :param num_workers: The number of CPU workers for loading images.
+    :param samples: The phases to build data loaders for (default: train, test, valid).
+    :param cache_dir: Directory of pre-decoded images built by build_cache; if None, images are read with ImageFolder.
+    :param training: A boolean indicating if the loaders are iterated by training; if False (e.g. for predictions),
+        they are never sharded, shuffled or cut short.
     :return: A tuple: dataloaders, dataset_sizes, class_names, num_classes.
     """
 
@@ -246,16 +344,134 @@ def get_dataloaders(data_dir, data_transforms, batch_size, num_workers):
         'valid': False
     }
 
-    samples = ['train', 'test', 'valid']
-    image_datasets = { x: datasets.ImageFolder(os.path.join(data_dir, x), transform=data_transforms[x]) for x in samples }
-    dataloaders = { x: torch.utils.data.DataLoader(image_datasets[x], batch_size=batch_size, shuffle=shuffles[x], num_workers=num_workers) for x in samples }
+    if cache_dir is None:
+        image_datasets = { x: datasets.ImageFolder(os.path.join(data_dir, x), transform=data_transforms[x]) for x in samples }
+    else:
+        image_datasets = { x: MmapImageDataset(os.path.join(cache_dir, x), transform=data_transforms[x]) for x in samples }
+
+    loader_params = {
+        'batch_size': batch_size,
+        'num_workers': num_workers,
+        'pin_memory': torch.cuda.is_available(),
+        'worker_init_fn': seed_worker
+    }
+    if num_workers > 0:
+        # only valid when loading with worker processes
+        loader_params['persistent_workers'] = True
+        loader_params['prefetch_factor'] = 4
+
+    def get_dataloader(x):
+        shuffle = shuffles[x] and training
+        # a fixed batch shape for training keeps the cudnn autotuner and CUDA graphs from re-recording
+        drop_last = x == 'train' and training
+        # predictions are only made by the main process, over the whole data
+        if is_distributed() and training:
+            sampler = DistributedSampler(image_datasets[x], shuffle=shuffle, drop_last=False)
+            return torch.utils.data.DataLoader(image_datasets[x], sampler=sampler, shuffle=False, drop_last=drop_last, **loader_params)
+        return torch.utils.data.DataLoader(image_datasets[x], shuffle=shuffle, drop_last=drop_last, **loader_params)
+
+    dataloaders = { x: get_dataloader(x) for x in samples }
     dataset_sizes = { x: len(image_datasets[x]) for x in samples }
-    class_names = image_datasets['train'].classes
+    class_names = image_datasets[samples[0]].classes
     
     return dataloaders, dataset_sizes, class_names, len(class_names)
 
 
-def train_model(model, criterion, optimizer, scheduler, dataloaders, dataset_sizes, num_epochs, is_inception):
+def get_num_unpadded(dataloader):
+    """
+    Gets the number of samples this process iterates over that are not padding.
+    DistributedSampler pads the data with repeated samples so that every rank
+    gets the same number; the padding always comes last on each rank.
+    :param dataloader: Data loader.
+    :return: Number of samples that are not padding, or None if the data loader is not padded.
+    """
+    sampler = dataloader.sampler
+    if not isinstance(sampler, DistributedSampler) or sampler.drop_last:
+        return None
+    return len(range(sampler.rank, len(sampler.dataset), sampler.num_replicas))
+
+
+def get_sync_context(model, sync):
+    """
+    Gets the context for a forward and backward pass. Under DDP, gradients
+    are not all-reduced when sync is False, so that accumulating batches do
+    not each pay for the communication.
+    :param model: Model.
+    :param sync: A boolean indicating if gradients should be all-reduced.
+    :return: Context manager.
+    """
+    ddp = getattr(model, '_orig_mod', model)
+    if not sync and isinstance(ddp, DDP):
+        return ddp.no_sync()
+    return nullcontext()
+
+
+class DataPrefetcher(object):
+    """
+    Prefetches batches from a data loader onto the device. On CUDA, the
+    host to device copy of the next batch is issued on a side stream while
+    the current batch is being computed on.
+    """
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format, normalize=None):
+        """
+        Ctor.
+        :param loader: Data loader.
+        :param device: Device.
+        :param memory_format: Memory format of the inputs on the device.
+        :param normalize: A tuple of mean, std on the device (see get_normalize_params) applied to the inputs, or None.
+        """
+        self.loader = iter(loader)
+        self.device = device
+        self.memory_format = memory_format
+        self.normalize = normalize
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+        if self.stream is not None:
+            # the normalization buffers were created on the current stream
+            self.stream.wait_stream(torch.cuda.current_stream())
+        self.preload()
+
+    def preload(self):
+        """
+        Loads the next batch and starts copying it to the device.
+        :return: None.
+        """
+        try:
+            self.next_inputs, self.next_labels = next(self.loader)
+        except StopIteration:
+            self.next_inputs, self.next_labels = None, None
+            return
+
+        if self.stream is None:
+            self.next_inputs = self.next_inputs.to(self.device, memory_format=self.memory_format)
+            self.next_labels = self.next_labels.to(self.device)
+            normalize_batch(self.next_inputs, self.normalize)
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_inputs = self.next_inputs.to(self.device, memory_format=self.memory_format, non_blocking=True)
+            self.next_labels = self.next_labels.to(self.device, non_blocking=True)
+            normalize_batch(self.next_inputs, self.normalize)
+
+    def next(self):
+        """
+        Gets the current batch and starts prefetching the one after it.
+        :return: A tuple: inputs, labels; both are None when the loader is exhausted.
+        """
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+
+        inputs, labels = self.next_inputs, self.next_labels
+        if inputs is not None and self.stream is not None:
+            # tensors were allocated on the side stream but are consumed on the current one
+            inputs.record_stream(torch.cuda.current_stream())
+            labels.record_stream(torch.cuda.current_stream())
+
+        self.preload()
+        return inputs, labels
+
+
+def train_model(model, criterion, optimizer, scheduler, dataloaders, num_epochs, is_inception, normalizations=None, accum_steps=1, feature_extract=False):
     """
     Starts the training.
     :param model: Model.
@@ -263,85 +479,146 @@ def train_model(model, criterion, optimizer, scheduler, dataloaders, dataset_siz
     :param optimizer: Optimizer.
     :param scheduler: Scheduler.
     :param dataloaders: Data loaders.
-    :param dataset_sizes: Dataset sizes.
     :param num_epochs: Number of epochs to train for.
     :param is_inception: A boolean indicating if the model is Inception v3.
+    :param normalizations: Normalize transforms per phase, applied to the batches on the device.
+    :param accum_steps: Number of batches to accumulate gradients over per optimizer step.
+    :param feature_extract: A boolean indicating if we are extracting features; if so, BatchNorm statistics are frozen.
     :return: Model.
     """
     device = get_device()
     Result = namedtuple('Result', 'phase loss acc')
 
+    # mixed precision; gradient scaling is only needed for FP16, a disabled scaler is a pass-through
+    use_amp = device.type == 'cuda'
+    amp_dtype = get_autocast_dtype(device)
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp and amp_dtype == torch.float16)
+    memory_format = get_memory_format(is_inception)
+    normalizations = {} if normalizations is None else normalizations
+    normalize_params = { x: get_normalize_params(normalizations.get(x), device) for x in ['train', 'test'] }
+
+    def optimizer_step():
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+
     since = time.time()
 
-    best_model_wts = copy.deepcopy(model.state_dict())
+    # best weights are checkpointed to disk instead of kept as a second in-memory copy
+    best_ckpt_path = '/tmp/oneoffcoder-{}-best.pth'.format(get_ms_past_epoch())
     best_acc = 0.0
     
     for epoch in range(num_epochs):
         results = []
         # Each epoch has a training and validation phase
         for phase in ['train', 'test']:
+            if isinstance(dataloaders[phase].sampler, DistributedSampler):
+                dataloaders[phase].sampler.set_epoch(epoch)
+
             if phase == 'train':
-                optimizer.step()
-                scheduler.step()
                 model.train()  # Set model to training mode
+                if feature_extract:
+                    freeze_bn(model)
             else:
                 model.eval()   # Set model to evaluate mode
 
-            running_loss = 0.0
-            running_corrects = 0
+            # accumulated on the device, read back once per phase to avoid a sync per batch
+            running_loss = torch.zeros((), device=device)
+            running_corrects = torch.zeros((), dtype=torch.long, device=device)
+            # samples actually seen, which differs from the dataset size with drop_last or sharding
+            num_samples = 0
+            # batches whose gradients have been accumulated
+            num_steps = 0
+            num_batches = len(dataloaders[phase])
+            # repeated samples padding a sharded test set are left out of its statistics
+            num_unpadded = get_num_unpadded(dataloaders[phase]) if phase == 'test' else None
 
-            # Iterate over data.
-            for inputs, labels in dataloaders[phase]:
-                inputs = inputs.to(device)
-                labels = labels.to(device)
+            # zero the parameter gradients
+            optimizer.zero_grad(set_to_none=True)
 
-                # zero the parameter gradients
-                optimizer.zero_grad()
+            # Iterate over data.
+            prefetcher = DataPrefetcher(dataloaders[phase], device, memory_format, normalize_params[phase])
+            inputs, labels = prefetcher.next()
+            while inputs is not None:
+                # gradients are synced on the batch that steps the optimizer, or the last one of the phase
+                sync = phase != 'train' or (num_steps + 1) % accum_steps == 0 or prefetcher.next_inputs is None
 
                 # forward
                 # track history if only in train
-                with torch.set_grad_enabled(phase == 'train'):
-                    if is_inception and phase == 'train':
-                        outputs, aux_outputs = model(inputs)
-                        loss1 = criterion(outputs, labels)
-                        loss2 = criterion(aux_outputs, labels)
-                        loss = loss1 + 0.4*loss2
-                    else:
-                        outputs = model(inputs)
-                        loss = criterion(outputs, labels)
+                with torch.set_grad_enabled(phase == 'train'), get_sync_context(model, sync):
+                    with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                        if is_inception and phase == 'train':
+                            outputs, aux_outputs = model(inputs)
+                            loss = criterion(outputs, labels).add_(criterion(aux_outputs, labels), alpha=0.4)
+                        else:
+                            outputs = model(inputs)
+                            if num_unpadded is not None:
+                                n = max(min(num_unpadded - num_samples, labels.size(0)), 0)
+                                outputs, labels = outputs[:n], labels[:n]
+                            loss = criterion(outputs, labels)
                         
                     _, preds = torch.max(outputs, 1)
                     
-                    # backward + optimize only if in training phase
+                    # backward + optimize only if in training phase, every accum_steps batches
                     if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
+                        # the last window of the phase may be shorter; average over the batches actually in it
+                        window_start = num_steps - num_steps % accum_steps
+                        window_size = max(min(accum_steps, num_batches - window_start), 1)
+                        scaler.scale(loss / window_size).backward()
+                        num_steps += 1
+                        if num_steps % accum_steps == 0:
+                            optimizer_step()
                         
                 # statistics
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
+                if labels.size(0) > 0:
+                    running_loss += loss.detach() * labels.size(0)
+                    running_corrects += (preds == labels).sum()
+                    num_samples += labels.size(0)
+
+                inputs, labels = prefetcher.next()
+
+            if phase == 'train':
+                # apply gradients left over from an incomplete accumulation
+                if num_steps % accum_steps != 0:
+                    optimizer_step()
+                scheduler.step()
+
+            if is_distributed():
+                dist.all_reduce(running_loss)
+                dist.all_reduce(running_corrects)
+                counts = torch.tensor(num_samples, device=device)
+                dist.all_reduce(counts)
+                num_samples = counts.item()
 
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
+            # the only device to host syncs of the phase
+            epoch_loss = running_loss.item() / max(num_samples, 1)
+            epoch_acc = running_corrects.item() / max(num_samples, 1)
             
-            result = Result(phase, epoch_loss, float(str(epoch_acc.cpu().numpy())))
+            result = Result(phase, epoch_loss, epoch_acc)
             results.append(result)
 
-            # deep copy the model
+            # checkpoint the best model
             if phase == 'test' and epoch_acc > best_acc:
                 best_acc = epoch_acc
-                best_model_wts = copy.deepcopy(model.state_dict())
+                if is_main_process():
+                    torch.save(unwrap_model(model).state_dict(), best_ckpt_path)
         
-        results = ['{} loss: {:.4f} acc: {:.4f}'.format(r.phase, r.loss, r.acc) for r in results]
-        results = ' | '.join(results)
-        print('Epoch {}/{} | {}'.format(epoch, num_epochs - 1, results))
+        if is_main_process():
+            results = ['{} loss: {:.4f} acc: {:.4f}'.format(r.phase, r.loss, r.acc) for r in results]
+            results = ' | '.join(results)
+            print('Epoch {}/{} | {}'.format(epoch, num_epochs - 1, results))
+
+    if not is_main_process():
+        return model
 
     time_elapsed = time.time() - since
     print('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
     print('Best val Acc: {:4f}'.format(best_acc))
 
     # load best model weights
-    model.load_state_dict(best_model_wts)
+    if path.exists(best_ckpt_path):
+        unwrap_model(model).load_state_dict(torch.load(best_ckpt_path))
+        os.remove(best_ckpt_path)
     return model
 
 
@@ -364,7 +641,7 @@ def save_model(model_type, model, ms=int(round(time.time() * 1000)), output_dir=
     o_dir = '/tmp' if output_dir is None or len(output_dir.strip()) == 0 else output_dir.strip()
     output_file = 'oneoffcoder-{}-{}.pth'.format(ms, model_type)
     output_path = '{}/{}'.format(o_dir, output_file)
-    torch.save(model.state_dict(), output_path)
+    torch.save(unwrap_model(model).state_dict(), output_path)
     print('saved model to {}'.format(output_path))
 
 
@@ -378,10 +655,96 @@ def load_model(model_type, num_classes, feature_extract, model_path):
     :return: Model.
     """
     model = create_model(model_type, num_classes, feature_extract, False)
-    model.load_state_dict(torch.load(model_path))
+    unwrap_model(model).load_state_dict(torch.load(model_path))
     return model
 
 
+# conv backbones that are statically quantized (conv + linear); all other models only get dynamic linear quantization
+STATIC_QUANTIZATION_TYPES = [
+    'resnet18', 'resnet34', 'resnet50', 'resnet101', 'resnet152',
+    'resnext50_32x4d', 'resnext101_32x8d', 'wide_resnet50_2', 'wide_resnet101_2',
+    'mobilenet_v2'
+]
+
+
+def quantize_model(model, model_type, dataloader, normalize=None, num_batches=10):
+    """
+    Quantizes a model to INT8 for CPU inference with FBGEMM. ResNet and
+    MobileNet conv stacks are statically quantized with FX graph mode,
+    calibrating on the data loader. Other models (e.g. VGG, AlexNet)
+    only have their Linear layers dynamically quantized. The model is
+    moved to the CPU.
+    :param model: Model.
+    :param model_type: Model type.
+    :param dataloader: Data loader used to calibrate static quantization.
+    :param normalize: Normalize transform applied to the calibration batches, or None.
+    :param num_batches: Maximum number of batches used for calibration.
+    :return: Quantized model, or None if the model has no layers to quantize (e.g. SqueezeNet).
+    """
+    # imported here so that only -q requires a PyTorch with torch.ao
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    model = unwrap_model(model)
+    is_static = model_type in STATIC_QUANTIZATION_TYPES
+    if not is_static and not any(isinstance(m, nn.Linear) for m in model.modules()):
+        return None
+
+    torch.backends.quantized.engine = 'fbgemm'
+    model = model.cpu().to(memory_format=torch.contiguous_format).float().eval()
+
+    if not is_static:
+        return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    normalize_params = get_normalize_params(normalize, torch.device('cpu'))
+    input_size = get_input_size(model_type)
+    example_inputs = (torch.randn(1, 3, input_size, input_size),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping('fbgemm'), example_inputs)
+
+    with torch.no_grad():
+        for i, (inputs, _) in enumerate(dataloader):
+            if i >= num_batches:
+                break
+            prepared(normalize_batch(inputs, normalize_params))
+
+    return convert_fx(prepared)
+
+
+def save_quantized_model(model_type, model, dataloaders, normalizations=None, ms=int(round(time.time() * 1000)), output_dir=None):
+    """
+    Quantizes and saves the model as TorchScript. Calibration uses the
+    validation data loader. Nothing is saved if the model has no layers
+    that can be quantized.
+    :param model_type: Model type.
+    :param model: Model.
+    :param dataloaders: Data loaders.
+    :param normalizations: Normalize transforms per phase.
+    :output_dir: Output directory.
+    :return: None.
+    """
+    normalize = None if normalizations is None else normalizations.get('valid')
+    qmodel = quantize_model(model, model_type, dataloaders['valid'], normalize=normalize)
+    if qmodel is None:
+        print('model {} has no layers that can be quantized, skipping'.format(model_type))
+        return
+
+    o_dir = '/tmp' if output_dir is None or len(output_dir.strip()) == 0 else output_dir.strip()
+    output_file = 'oneoffcoder-{}-{}-int8.pt'.format(ms, model_type)
+    output_path = '{}/{}'.format(o_dir, output_file)
+    torch.jit.save(torch.jit.script(qmodel), output_path)
+    print('saved quantized model to {}'.format(output_path))
+
+
+def load_quantized_model(model_path):
+    """
+    Loads a quantized TorchScript model for CPU inference.
+    :param model_path: Model path.
+    :return: Model.
+    """
+    torch.backends.quantized.engine = 'fbgemm'
+    return torch.jit.load(model_path, map_location='cpu')
+
+
 def get_model(model_type, num_classes, feature_extract, pretrained, model_path):
     """
     Gets a model. If the model_path is not null and has length greater
@@ -408,6 +771,14 @@ def get_model(model_type, num_classes, feature_extract, pretrained, model_path):
 
 
 def get_data_transforms(input_size, args_transform):
+    """
+    Gets the data transforms. A trailing Normalize is split out of each
+    phase so that it runs on whole batches on the device instead of per
+    image in the CPU workers.
+    :param input_size: Input size to the model.
+    :param args_transform: Transform options from the command line.
+    :return: A tuple: transforms, normalizations; both keyed by phase.
+    """
     def_transforms = get_default_transforms(input_size)
     if args_transform is not None:
         arg_transforms = get_transforms(args_transform)
@@ -418,7 +789,7 @@ def get_data_transforms(input_size, args_transform):
         if 'valid' in arg_transforms:
             def_transforms['valid'] = arg_transforms['valid']
 
-    return def_transforms
+    return split_normalize(def_transforms)
 
 
 def parse_args(args):
@@ -499,6 +870,11 @@ def parse_args(args):
     
     parser.add_argument('-b', '--batch_size', help='batch size (default: 4)', required=False, default=4, type=int)
     
+    parser.add_argument('--accum_steps', help="""number of batches to accumulate gradients over (default: 1)
+    The optimizer steps once every accum_steps batches, so the effective batch
+    size is batch_size * accum_steps while memory use stays that of batch_size.
+    """.strip(), required=False, default=1, type=int)
+
     parser.add_argument('-e', '--epochs', help='number of epochs (default: 25)', required=False, default=25, type=int)
     
     parser.add_argument('-p', help="""use transfer learning by loading pretrained weights (default: True)
@@ -541,12 +917,36 @@ def parse_args(args):
     as a starting point for training.
     """.strip(), required=False, default=None)
 
+    parser.add_argument('--cache_dir', help="""directory to cache decoded images in (default: None)
+    e.g. /path/to/cache
+    If specified, the images of each phase are decoded, resized and center cropped
+    to the input size of the model once, and stored as memory-mapped arrays under
+    [cache_dir]/[input_size]/[phase]; later epochs and runs read from the cache
+    instead of decoding JPEGs again. A phase is rebuilt if its data directory, classes
+    or number of images changed since it was cached. When distributed, the process with
+    LOCAL_RANK 0 on each node builds the cache, so it may be on node-local or shared disk.
+    """.strip(), required=False, default=None)
+
+    parser.add_argument('--cache_timeout', help="""seconds the other processes wait for the image cache to be built (default: 21600)
+    When distributed, processes other than LOCAL_RANK 0 wait for the cache and fail
+    with an error if it is not complete in time.
+    """.strip(), required=False, default=21600, type=int)
+
+    parser.add_argument('-q', '--quantize', help="""quantize the trained model to INT8 for CPU inference (default: False)
+    This option is a flag. If used, a TorchScript INT8 model is saved to the
+    output directory in addition to the FP32 weights.
+    """.strip(), action='store_true', required=False, default=False)
+
     parser.add_argument('--figure_width', help='figure width (default: 20)', required=False, type=int, default=20)
     parser.add_argument('--figure_height', help='figure height (default: 8)', required=False, type=int, default=8)
 
     parser.add_argument('--version', action='version', version='%(prog)s v0.0.1')
 
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if args.accum_steps < 1:
+        parser.error('--accum_steps must be at least 1')
+
+    return args
 
 
 def do_it(args):
@@ -555,6 +955,8 @@ def do_it(args):
     :param args: Arguments.
     :return: None.
     """
+    configure_backends()
+
     data_dir = args.data_dir
     model_type = args.model_type
     input_size = get_input_size(model_type)
@@ -562,11 +964,25 @@ def do_it(args):
     num_workers = args.num_workers
 
     print('creating data transforms')
-    data_transforms = get_data_transforms(input_size, args.transform)
+    data_transforms, normalizations = get_data_transforms(input_size, args.transform)
     
+    # the cache is built by one process per node (so it also works on node-local disk) before the
+    # process group exists; the other ranks wait on the cache files instead of a collective
+    cache_dir = None
+    if args.cache_dir is not None:
+        cache_dir = os.path.join(args.cache_dir, str(input_size))
+        if is_local_main_process():
+            print('building image cache')
+            build_cache(data_dir, cache_dir, input_size, ['train', 'test'], num_workers)
+        else:
+            print('waiting for image cache')
+            wait_for_cache(data_dir, cache_dir, input_size, ['train', 'test'], args.cache_timeout)
+
+    init_distributed()
+
     print('creating data loaders')
-    dataloaders, dataset_sizes, _, num_classes = \
-        get_dataloaders(data_dir, data_transforms, batch_size, num_workers)
+    dataloaders, _, _, num_classes = \
+        get_dataloaders(data_dir, data_transforms, batch_size, num_workers, samples=['train', 'test'], cache_dir=cache_dir)
     
     model_path = args.load_model
     feature_extract = args.feature_extract
@@ -605,9 +1021,15 @@ def do_it(args):
         'optimizer': optimizer, 
         'scheduler': scheduler, 
         'dataloaders': dataloaders, 
-        'dataset_sizes': dataset_sizes, 
         'num_epochs': num_epochs, 
-        'is_inception': is_inception})
+        'is_inception': is_inception,
+        'normalizations': normalizations,
+        'accum_steps': args.accum_steps,
+        'feature_extract': feature_extract})
+
+    cleanup_distributed()
+    if not is_main_process():
+        return
 
     output_dir = args.output_dir
     ms = get_ms_past_epoch()
@@ -615,8 +1037,14 @@ def do_it(args):
     print('saving model')
     save_model(model_type, model, ms=ms, output_dir=output_dir)
     
+    print('creating prediction data loaders')
+    if cache_dir is not None:
+        build_cache(data_dir, cache_dir, input_size, ['valid'], num_workers)
+    dataloaders, _, _, _ = \
+        get_dataloaders(data_dir, data_transforms, batch_size, num_workers, cache_dir=cache_dir, training=False)
+
     print('saving predictions')
-    p = get_predictions(model, dataloaders)
+    p = get_predictions(unwrap_model(model), dataloaders, normalizations)
     figure_width = args.figure_width
     figure_height = args.figure_height
     save_predictions(**{
@@ -627,6 +1055,10 @@ def do_it(args):
         'figure_height': figure_height
     })
 
+    if args.quantize:
+        print('saving quantized model')
+        save_quantized_model(model_type, model, dataloaders, normalizations, ms=ms, output_dir=output_dir)
+
     print('done')
 
 
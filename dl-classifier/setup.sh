@@ -9,7 +9,7 @@ updateAptPackages() {
 
 installAnaconda() {
     echo "installing anaconda"
-    wget -q https://repo.anaconda.com/archive/Anaconda3-2019.03-Linux-x86_64.sh -O /tmp/anaconda.sh
+    wget -q https://repo.anaconda.com/archive/Anaconda3-2023.09-0-Linux-x86_64.sh -O /tmp/anaconda.sh
     /bin/bash /tmp/anaconda.sh -b -p $CONDA_HOME
     rm -fr /tmp/anaconda.sh
 } 
@@ -17,8 +17,8 @@ installAnaconda() {
 installPytorch() {
     echo "installing pytorch"
     conda install --yes \
-        -c pytorch \
-        scikit-learn=0.21.1 pytorch torchvision cudatoolkit=10.0 seaborn=0.9.0
+        -c pytorch -c nvidia \
+        scikit-learn=1.3.0 pytorch=2.3 torchvision=0.18 pytorch-cuda=12.1 seaborn=0.12.2
 }
 
 downloadModels() {